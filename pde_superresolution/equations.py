@@ -18,13 +18,17 @@ from __future__ import division
 from __future__ import print_function
 
 import enum
+import functools
 import json
+import math
 
+import numba
 import numpy as np
 import tensorflow as tf
-from typing import Mapping, Tuple, Type, TypeVar
+from typing import Callable, Mapping, Optional, Tuple, Type, TypeVar
 
 from pde_superresolution import duckarray  # pylint: disable=g-bad-import-order
+from pde_superresolution import layers  # pylint: disable=g-bad-import-order
 from pde_superresolution import polynomials  # pylint: disable=g-bad-import-order
 
 
@@ -33,6 +37,38 @@ from pde_superresolution import polynomials  # pylint: disable=g-bad-import-orde
 T = TypeVar('T')
 
 
+def _apply_kernel(kernel, arrays, *args):
+  """Apply a numba kernel over 2D views of arrays with shape [..., x].
+
+  Args:
+    kernel: jitted function called as `kernel(*arrays_2d, *args, out)`, where
+      each array has been reshaped to [batch, x].
+    arrays: sequence of NumPy arrays, which are broadcast against each other.
+    *args: additional scalar arguments for the kernel.
+
+  Returns:
+    New array with the broadcast shape and result dtype of the inputs.
+  """
+  # jitted kernels don't check bounds, so mismatched shapes must be broadcast
+  # (the common case of matching shapes skips the overhead of broadcasting)
+  shape = arrays[0].shape
+  if any(array.shape != shape for array in arrays[1:]):
+    shape = np.broadcast_shapes(*[array.shape for array in arrays])
+    arrays = [np.broadcast_to(array, shape) for array in arrays]
+  arrays_2d = [array.reshape(-1, shape[-1]) for array in arrays]
+  out = np.empty(arrays_2d[0].shape, np.result_type(*arrays))
+  kernel(*arrays_2d, *args, out)
+  return out.reshape(shape)
+
+
+@functools.lru_cache(maxsize=None)
+def _grid_x(num_points: int, period: float) -> np.ndarray:
+  """Read-only grid positions, shared between all grids of the same size."""
+  x = (period / num_points) * np.arange(num_points)
+  x.flags.writeable = False
+  return x
+
+
 @enum.unique
 class ExactMethod(enum.Enum):
   """Method to use for the "exact" solution at high resolution."""
@@ -41,6 +77,13 @@ class ExactMethod(enum.Enum):
   WENO = 3
 
 
+class StencilKernel(enum.IntEnum):
+  """Fused kernel for stencil_time_derivative() on conservative equations."""
+  BURGERS = 1
+  KDV = 2
+  KS = 3
+
+
 class Grid(object):
   """Object for keeping track of grids and resampling."""
 
@@ -56,11 +99,11 @@ class Grid(object):
 
     self.solution_num_points = solution_num_points
     self.solution_dx = period / solution_num_points
-    self.solution_x = self.solution_dx * np.arange(solution_num_points)
+    self.solution_x = _grid_x(solution_num_points, period)
 
     self.reference_num_points = solution_num_points * resample_factor
     self.reference_dx = period / self.reference_num_points
-    self.reference_x = self.reference_dx * np.arange(self.reference_num_points)
+    self.reference_x = _grid_x(self.reference_num_points, period)
 
   def resample(self, x: T, axis: int = -1) -> T:
     """Resample from the reference resolution to the solution resolution."""
@@ -82,7 +125,8 @@ class Equation(object):
                num_points: int,
                resample_factor: int = 1,
                period: float = 1.0,
-               random_seed: int = 0):
+               random_seed: int = 0,
+               dtype: np.dtype = np.float64):
     """Constructor.
 
     Args:
@@ -93,6 +137,7 @@ class Equation(object):
         values appropriate for the equation being solved.
       random_seed: integer random seed for any stochastic aspects of the
         equation.
+      dtype: floating point dtype for NumPy calculations during integration.
     """
     # Note: Ideally we would pass in grid as a construtor argument, but we need
     # different default grids for different equations, so we initialize it here
@@ -100,6 +145,10 @@ class Equation(object):
     resample_method = 'mean' if self.CONSERVATIVE else 'subsample'
     self.grid = Grid(num_points, resample_factor, resample_method, period)
     self.random_seed = random_seed
+    self.dtype = np.dtype(dtype)
+    # Scratch space for intermediate results in NumPy equation_of_motion(),
+    # allocated on first use by _scratch().
+    self._buffers = {}
 
   def initial_value(self) -> np.ndarray:
     """Initial condition for time integration."""
@@ -133,6 +182,100 @@ class Equation(object):
     """
     raise NotImplementedError
 
+  def _inv_dx(self, like: np.ndarray) -> np.floating:
+    """Inverse grid spacing, as a scalar with the same dtype as `like`."""
+    return like.dtype.type(1 / self.grid.solution_dx)
+
+  def _scratch(self, index: int, like: np.ndarray) -> np.ndarray:
+    """Return scratch buffer `index`, with the same shape/dtype as `like`.
+
+    Only the NumPy Godunov fluxes use scratch buffers. Equations that do are
+    not thread-safe, so they should not be shared between concurrent
+    integrations. Results must still be returned in new arrays, because
+    solve_ivp holds on to returned time derivatives between evaluations.
+    """
+    buffer = self._buffers.get(index)
+    if (buffer is None or buffer.shape != like.shape
+        or buffer.dtype != like.dtype):
+      buffer = self._buffers[index] = np.empty_like(like)
+    return buffer
+
+  def _godunov_convective_flux(self, u_minus: T, u_plus: T) -> T:
+    """godunov_convective_flux(), in scratch space for NumPy arrays.
+
+    Args:
+      u_minus: reconstructed values on the left side of each cell boundary.
+      u_plus: reconstructed values on the right side of each cell boundary.
+
+    Returns:
+      Convective flux. For NumPy inputs, this is scratch buffer 2, and is only
+      valid until the next call.
+    """
+    if not isinstance(u_minus, np.ndarray):
+      return godunov_convective_flux(u_minus, u_plus)
+    u_minus_squared = np.square(u_minus, out=self._scratch(0, u_minus))
+    u_plus_squared = np.square(u_plus, out=self._scratch(1, u_plus))
+    flux = np.maximum(u_minus_squared, u_plus_squared,
+                      out=self._scratch(2, u_minus))
+    np.minimum(u_minus_squared, u_plus_squared, out=u_minus_squared)
+    np.copyto(flux, u_minus_squared, where=u_minus <= u_plus)
+    flux *= 0.5
+    return flux
+
+  def stencil_time_derivative(
+      self, y: np.ndarray, coefficients: np.ndarray) -> np.ndarray:
+    """Time derivatives of `y` using fixed finite difference stencils.
+
+    This is equivalent to calculating spatial derivatives with
+    polynomials.apply_stencils() and passing them to equation_of_motion(), but
+    these steps are fused into a single kernel for equations that implement
+    stencil_kernel().
+
+    Args:
+      y: float np.ndarray with dimensions [..., x] giving current function
+        values.
+      coefficients: float np.ndarray with dimensions [derivative, stencil_size]
+        giving stacked coefficients for each of DERIVATIVE_NAMES, e.g., from
+        model.baseline_coefficients().
+
+    Returns:
+      ndarray with same dtype/shape as `y` giving the partial derivative of `y`
+      with respect to time according to this equation.
+    """
+    stencil_kernel = self.stencil_kernel()
+    if stencil_kernel is not None:
+      kernel, parameter = stencil_kernel
+      return _apply_kernel(
+          _conservative_stencil_kernel, [y], int(kernel), coefficients,
+          y.dtype.type(parameter), self._inv_dx(y))
+    derivatives = polynomials.apply_stencils(y, coefficients)
+    return self.equation_of_motion(
+        y, dict(zip(self.DERIVATIVE_NAMES, derivatives)))
+
+  def stencil_kernel(self) -> Optional[Tuple[StencilKernel, float]]:
+    """Fused kernel for stencil_time_derivative() and jitted integration.
+
+    The default implementation returns None, for equations without a fused
+    stencil kernel.
+
+    Returns:
+      Tuple `(kernel, parameter)` identifying the kernel and a scalar parameter
+      for it (e.g., eta for Burgers' equation), or None.
+    """
+    return None
+
+  def forcing_terms(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Forcing added by finalize_time_derivative(), for jitted integration.
+
+    The default implementation adds no forcing.
+
+    Returns:
+      Tuple of arrays `(amplitude, omega, basis)` in the format of
+      RandomForcing.solution_terms().
+    """
+    return (np.zeros(0, self.dtype), np.zeros(0, self.dtype),
+            np.zeros((0, self.grid.solution_num_points), self.dtype))
+
   def finalize_time_derivative(self, t: float, y_t: np.ndarray) -> np.ndarray:
     """Finalize time derivatives for integrations.
 
@@ -193,6 +336,27 @@ class Equation(object):
     return self.conservative_type()(**self.params())
 
 
+@functools.lru_cache(maxsize=128)
+def _forcing_phase_and_basis(
+    k: Tuple[int, ...],
+    phi: Tuple[float, ...],
+    num_points: int,
+    period: float,
+    dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray]:
+  """Read-only phase and trig basis for RandomForcing, with shape (k, x)."""
+  x = _grid_x(num_points, period)
+  k = np.array(k)[:, np.newaxis]
+  phi = np.array(phi)[:, np.newaxis]
+  # time independent part of the phase, with shape (nparams, x)
+  phase_sx = 2 * np.pi * k * x / period + phi
+  # sin(omega*t + phase) = sin(omega*t)*cos(phase) + cos(omega*t)*sin(phase),
+  # so only the 2*nparams time dependent weights change between calls.
+  basis = np.concatenate([np.cos(phase_sx), np.sin(phase_sx)]).astype(dtype)
+  phase_sx.flags.writeable = False
+  basis.flags.writeable = False
+  return phase_sx, basis
+
+
 class RandomForcing(object):
   """Deterministic random forcing, periodic in both space and time."""
 
@@ -202,7 +366,8 @@ class RandomForcing(object):
                seed: int = 0,
                amplitude: float = 1,
                k_min: int = 1,
-               k_max: int = 3):
+               k_max: int = 3,
+               dtype: np.dtype = np.float64):
     self.grid = grid
     rs = np.random.RandomState(seed)
     self.a = 0.5 * amplitude * rs.uniform(-1, 1, size=(nparams, 1))
@@ -211,13 +376,42 @@ class RandomForcing(object):
     self.k = rs.choice(np.concatenate([-k_values, k_values]), size=(nparams, 1))
     self.phi = rs.uniform(0, 2 * np.pi, size=(nparams, 1))
 
+    # equations converted with to_exact() or to_conservative() share the same
+    # forcing, so the phases are cached rather than recomputed
+    self._phase_sx, self._basis = _forcing_phase_and_basis(
+        tuple(self.k.ravel()), tuple(self.phi.ravel()),
+        grid.reference_num_points, grid.period, np.dtype(dtype))
+    self._a_flat = self.a.ravel()
+    self._omega_flat = self.omega.ravel()
+
   def __call__(self, t: float) -> np.ndarray:
-    spatial_phase = (2 * np.pi * self.k * self.grid.reference_x
-                     / self.grid.period)
-    signals = duckarray.sin(self.omega * t + spatial_phase + self.phi)
-    reference_forcing = duckarray.sum(self.a * signals, axis=0)
+    if isinstance(t, tf.Tensor):
+      signals = tf.sin(self.omega * t + self._phase_sx)
+      reference_forcing = tf.reduce_sum(self.a * signals, axis=0)
+    else:
+      # the time dependent weights and the reduction over the basis are fused
+      # in a single jitted loop, without (nparams, x) intermediates.
+      reference_forcing = np.zeros((1, self._basis.shape[-1]),
+                                   self._basis.dtype)
+      _add_forcing_kernel(t, self._a_flat[np.newaxis],
+                          self._omega_flat[np.newaxis],
+                          self._basis[np.newaxis], reference_forcing)
+      reference_forcing = reference_forcing[0]
     return self.grid.resample(reference_forcing)
 
+  def solution_terms(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parameters for evaluating this forcing on the solution grid.
+
+    Returns:
+      Tuple of arrays `(amplitude, omega, basis)` with shapes (nparams,),
+      (nparams,) and (2*nparams, x), such that the forcing at time t is
+      `sum(amplitude * sin(omega * t) * basis[:nparams] + amplitude
+      * cos(omega * t) * basis[nparams:], axis=0)`.
+    """
+    dtype = self._basis.dtype
+    return (self._a_flat.astype(dtype), self._omega_flat.astype(dtype),
+            self.grid.resample(self._basis))
+
   def export(self, path):
     """Export to a text file."""
     p = np.zeros_like(self.a)
@@ -227,6 +421,19 @@ class RandomForcing(object):
     np.savetxt(path, array)
 
 
+@functools.lru_cache(maxsize=None)
+def _burgers_kernel(eta: float) -> Callable:
+  """Fused BurgersEquation.equation_of_motion on 2D arrays, for a given eta."""
+  # eta is compiled into the kernel as a constant. Closures can't be cached on
+  # disk, but they are only compiled once per process and value of eta.
+  @numba.njit(nogil=True, fastmath=True)
+  def kernel(y, y_x, y_xx, out):
+    for b in range(y.shape[0]):
+      for i in range(y.shape[1]):
+        out[b, i] = eta * y_xx[b, i] - y[b, i] * y_x[b, i]
+  return kernel
+
+
 class BurgersEquation(Equation):
   """Burger's equation with random forcing."""
 
@@ -244,17 +451,18 @@ class BurgersEquation(Equation):
                eta: float = 0.04,
                k_min: int = 1,
                k_max: int = 3,
+               dtype: np.dtype = np.float64,
               ):
     super(BurgersEquation, self).__init__(
-        num_points, resample_factor, period, random_seed)
+        num_points, resample_factor, period, random_seed, dtype)
     self.forcing = RandomForcing(self.grid, seed=random_seed, k_min=k_min,
-                                 k_max=k_max)
+                                 k_max=k_max, dtype=dtype)
     self.eta = eta
     self.k_min = k_min
     self.k_max = k_max
 
   def initial_value(self) -> np.ndarray:
-    return np.zeros_like(self.grid.solution_x)
+    return np.zeros(self.grid.solution_num_points, self.dtype)
 
   @property
   def time_step(self) -> float:
@@ -270,12 +478,17 @@ class BurgersEquation(Equation):
       self, y: T, spatial_derivatives: Mapping[str, T]) -> T:
     y_x = spatial_derivatives['u_x']
     y_xx = spatial_derivatives['u_xx']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_burgers_kernel(self.eta), [y, y_x, y_xx])
     y_t = self.eta * y_xx - y * y_x
     return y_t
 
   def finalize_time_derivative(self, t: float, y_t: tf.Tensor) -> tf.Tensor:
     return y_t + self.forcing(t)
 
+  def forcing_terms(self):
+    return self.forcing.solution_terms()
+
   def params(self):
     return dict(
         num_points=self.grid.reference_num_points,
@@ -284,6 +497,7 @@ class BurgersEquation(Equation):
         eta=self.eta,
         k_min=self.k_min,
         k_max=self.k_max,
+        dtype=self.dtype,
     )
 
   def to_fine(self):
@@ -302,6 +516,63 @@ class BurgersEquation(Equation):
     return BurgersEquation
 
 
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _staggered_first_derivative_kernel(y, inv_dx, out):
+  """Periodic forward difference along the last axis of a 2D array."""
+  num_points = y.shape[1]
+  for b in range(y.shape[0]):
+    # Keep the inner loop free of wrap-around logic so LLVM can vectorize it
+    # (numba compiles a separate specialization for C-contiguous inputs).
+    for i in range(num_points - 1):
+      out[b, i] = (y[b, i + 1] - y[b, i]) * inv_dx
+    out[b, num_points - 1] = (y[b, 0] - y[b, num_points - 1]) * inv_dx
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _flux_divergence_kernel(flux, inv_dx, out):
+  """Time derivative from fluxes on the left boundary of each cell."""
+  _staggered_first_derivative_kernel(flux, -inv_dx, out)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _add_forcing_kernel(t, amplitude, omega, basis, out):
+  """Add batched forcing from RandomForcing.solution_terms() to out."""
+  nparams = amplitude.shape[1]
+  for b in range(out.shape[0]):
+    for p in range(nparams):
+      sin_weight = amplitude[b, p] * math.sin(omega[b, p] * t)
+      cos_weight = amplitude[b, p] * math.cos(omega[b, p] * t)
+      for i in range(out.shape[1]):
+        out[b, i] += (sin_weight * basis[b, p, i]
+                      + cos_weight * basis[b, nparams + p, i])
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def conservative_time_derivative(t, y, kernel, coefficients, parameter, inv_dx,
+                                 amplitude, omega, basis, out):
+  """Jitted time derivative for conservative equations with fixed stencils.
+
+  Equivalent to calling stencil_time_derivative() followed by
+  finalize_time_derivative(), for use inside other jitted functions.
+
+  Args:
+    t: current time.
+    y: array with dimensions [batch, x] giving current function values.
+    kernel: integer StencilKernel, from Equation.stencil_kernel().
+    coefficients: stacked stencils with dimensions [derivative, stencil_size].
+    parameter: parameter for the kernel, from Equation.stencil_kernel().
+    inv_dx: inverse of the spacing between grid points.
+    amplitude: forcing amplitudes from Equation.forcing_terms(), stacked
+      along a leading batch dimension.
+    omega: forcing frequencies, stacked like amplitude.
+    basis: forcing basis functions, stacked like amplitude.
+    out: array with dimensions [batch, x] in which to save the result.
+  """
+  _conservative_stencil_kernel(
+      y, kernel, coefficients, parameter, inv_dx, out)
+  _add_forcing_kernel(t, amplitude, omega, basis, out)
+
+
 def staggered_first_derivative(y: T, dx: float) -> T:
   """Calculate a first-order derivative with second order finite differences.
 
@@ -314,10 +585,48 @@ def staggered_first_derivative(y: T, dx: float) -> T:
   Returns:
     Differentiated array, same type and shape as `y`.
   """
-  # Use concat instead of roll because roll doesn't have GPU or TPU
-  # implementations in TensorFlow
-  y_forward = duckarray.concatenate([y[..., 1:], y[..., :1]], axis=-1)
-  return (1 / dx) * (y_forward - y)
+  if isinstance(y, np.ndarray):
+    return _apply_kernel(_staggered_first_derivative_kernel, [y], 1 / dx)
+
+  # Express the difference as a periodic convolution with the kernel [-1, 1],
+  # which XLA can fuse with the padding into a single kernel. (This also avoids
+  # roll, which doesn't have GPU or TPU implementations in TensorFlow.)
+  filters = tf.constant([[[-1]], [[1]]], dtype=y.dtype) / dx
+  num_points = layers.static_or_dynamic_size(y, axis=-1)
+  convolved = layers.nn_conv1d_periodic(
+      tf.reshape(y, [-1, num_points, 1]), filters)
+  result = tf.reshape(convolved, tf.shape(y))
+  result.set_shape(y.shape)
+  return result
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_burgers_flux(u, u_x, eta):
+  """Flux for ConservativeBurgersEquation at a single point."""
+  return 0.5 * u ** 2 - eta * u_x
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_burgers_kernel(y, y_x, eta, inv_dx, out):
+  """Fused ConservativeBurgersEquation.equation_of_motion on 2D arrays."""
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      flux[b, i] = _conservative_burgers_flux(y[b, i], y_x[b, i], eta)
+  _flux_divergence_kernel(flux, inv_dx, out)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_burgers_stencil_kernel(y, coefficients, eta, inv_dx, out):
+  """Fused ConservativeBurgersEquation.stencil_time_derivative on 2D arrays."""
+  padded = polynomials.periodic_pad(y, coefficients.shape[1])
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      u = polynomials.stencil_sum(padded, coefficients, 0, b, i)
+      u_x = polynomials.stencil_sum(padded, coefficients, 1, b, i)
+      flux[b, i] = _conservative_burgers_flux(u, u_x, eta)
+  _flux_divergence_kernel(flux, inv_dx, out)
 
 
 class ConservativeBurgersEquation(BurgersEquation):
@@ -333,10 +642,16 @@ class ConservativeBurgersEquation(BurgersEquation):
     del y  # unused
     y = spatial_derivatives['u']
     y_x = spatial_derivatives['u_x']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_conservative_burgers_kernel, [y, y_x],
+                           y.dtype.type(self.eta), 1 / self.grid.solution_dx)
     flux = 0.5 * y ** 2 - self.eta * y_x
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
 
+  def stencil_kernel(self) -> Tuple[StencilKernel, float]:
+    return StencilKernel.BURGERS, self.eta
+
 
 def godunov_convective_flux(u_minus, u_plus):
   """Calculate Godunov's flux for 0.5*u**2."""
@@ -364,12 +679,25 @@ class GodunovBurgersEquation(BurgersEquation):
     y_plus = spatial_derivatives['u_plus']
     y_x = spatial_derivatives['u_x']
 
-    convective_flux = godunov_convective_flux(y_minus, y_plus)
+    convective_flux = self._godunov_convective_flux(y_minus, y_plus)
+    if isinstance(convective_flux, np.ndarray):
+      flux = convective_flux
+      flux -= np.multiply(self.eta, y_x, out=self._scratch(0, y_x))
+      y_t = staggered_first_derivative(flux, self.grid.solution_dx)
+      return np.negative(y_t, out=y_t)
     flux = convective_flux - self.eta * y_x
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
 
 
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _kdv_kernel(y, y_x, y_xxx, out):
+  """Fused KdVEquation.equation_of_motion on 2D arrays."""
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      out[b, i] = -6 * y[b, i] * y_x[b, i] - y_xxx[b, i]
+
+
 class KdVEquation(Equation):
   """Korteweg-de Vries (KdV) equation with random initial conditions."""
 
@@ -386,11 +714,12 @@ class KdVEquation(Equation):
                random_seed: int = 0,
                k_min: int = 1,
                k_max: int = 3,
+               dtype: np.dtype = np.float64,
               ):
     super(KdVEquation, self).__init__(
-        num_points, resample_factor, period, random_seed)
+        num_points, resample_factor, period, random_seed, dtype)
     self.forcing = RandomForcing(self.grid, nparams=10, seed=random_seed,
-                                 k_min=k_min, k_max=k_max)
+                                 k_min=k_min, k_max=k_max, dtype=dtype)
     self.k_min = k_min
     self.k_max = k_max
 
@@ -411,6 +740,8 @@ class KdVEquation(Equation):
       self, y: T, spatial_derivatives: Mapping[str, T]) -> T:
     y_x = spatial_derivatives['u_x']
     y_xxx = spatial_derivatives['u_xxx']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_kdv_kernel, [y, y_x, y_xxx])
     y_t = -6 * y * y_x - y_xxx
     return y_t
 
@@ -421,6 +752,7 @@ class KdVEquation(Equation):
         random_seed=self.random_seed,
         k_min=self.k_min,
         k_max=self.k_max,
+        dtype=self.dtype,
     )
 
   def to_fine(self):
@@ -439,6 +771,35 @@ class KdVEquation(Equation):
     return KdVEquation
 
 
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_kdv_flux(u, u_xx):
+  """Flux for ConservativeKdVEquation at a single point."""
+  return 3 * u ** 2 + u_xx
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_kdv_kernel(y, y_xx, inv_dx, out):
+  """Fused ConservativeKdVEquation.equation_of_motion on 2D arrays."""
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      flux[b, i] = _conservative_kdv_flux(y[b, i], y_xx[b, i])
+  _flux_divergence_kernel(flux, inv_dx, out)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_kdv_stencil_kernel(y, coefficients, inv_dx, out):
+  """Fused ConservativeKdVEquation.stencil_time_derivative on 2D arrays."""
+  padded = polynomials.periodic_pad(y, coefficients.shape[1])
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      u = polynomials.stencil_sum(padded, coefficients, 0, b, i)
+      u_xx = polynomials.stencil_sum(padded, coefficients, 1, b, i)
+      flux[b, i] = _conservative_kdv_flux(u, u_xx)
+  _flux_divergence_kernel(flux, inv_dx, out)
+
+
 class ConservativeKdVEquation(KdVEquation):
   """KdV constrained to obey the continuity equation."""
 
@@ -452,10 +813,16 @@ class ConservativeKdVEquation(KdVEquation):
     del y  # unused
     y = spatial_derivatives['u']
     y_xx = spatial_derivatives['u_xx']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_conservative_kdv_kernel, [y, y_xx],
+                           1 / self.grid.solution_dx)
     flux = 3 * y ** 2 + y_xx
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
 
+  def stencil_kernel(self) -> Tuple[StencilKernel, float]:
+    return StencilKernel.KDV, 0.0
+
 
 class GodunovKdVEquation(KdVEquation):
   """Conservative KdV using Godunov numerical flux."""
@@ -472,12 +839,26 @@ class GodunovKdVEquation(KdVEquation):
     y_plus = spatial_derivatives['u_plus']
     y_xx = spatial_derivatives['u_xx']
 
-    convective_flux = godunov_convective_flux(y_minus, y_plus)
+    convective_flux = self._godunov_convective_flux(y_minus, y_plus)
+    if isinstance(convective_flux, np.ndarray):
+      flux = convective_flux
+      flux *= 6
+      flux += y_xx
+      y_t = staggered_first_derivative(flux, self.grid.solution_dx)
+      return np.negative(y_t, out=y_t)
     flux = 6 * convective_flux + y_xx
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
 
 
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _ks_kernel(y, y_x, y_xx, y_xxxx, out):
+  """Fused KSEquation.equation_of_motion on 2D arrays."""
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      out[b, i] = -y[b, i] * y_x[b, i] - y_xxxx[b, i] - y_xx[b, i]
+
+
 class KSEquation(Equation):
   """Kuramoto-Sivashinsky (KS) equation with random initial conditions."""
 
@@ -494,11 +875,12 @@ class KSEquation(Equation):
                random_seed: int = 0,
                k_min: int = 1,
                k_max: int = 3,
+               dtype: np.dtype = np.float64,
               ):
     super(KSEquation, self).__init__(
-        num_points, resample_factor, period, random_seed)
+        num_points, resample_factor, period, random_seed, dtype)
     self.forcing = RandomForcing(self.grid, nparams=10, seed=random_seed,
-                                 k_min=k_min, k_max=k_max)
+                                 k_min=k_min, k_max=k_max, dtype=dtype)
     self.k_min = k_min
     self.k_max = k_max
 
@@ -520,6 +902,8 @@ class KSEquation(Equation):
     y_x = spatial_derivatives['u_x']
     y_xx = spatial_derivatives['u_xx']
     y_xxxx = spatial_derivatives['u_xxxx']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_ks_kernel, [y, y_x, y_xx, y_xxxx])
     y_t = -y*y_x - y_xxxx - y_xx
     return y_t
 
@@ -530,6 +914,7 @@ class KSEquation(Equation):
         random_seed=self.random_seed,
         k_min=self.k_min,
         k_max=self.k_max,
+        dtype=self.dtype,
     )
 
   def to_fine(self):
@@ -548,6 +933,105 @@ class KSEquation(Equation):
     return KSEquation
 
 
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_ks_flux(u, u_x, u_xxx):
+  """Flux for ConservativeKSEquation at a single point."""
+  return 0.5 * u ** 2 + u_xxx + u_x
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_ks_kernel(y, y_x, y_xxx, inv_dx, out):
+  """Fused ConservativeKSEquation.equation_of_motion on 2D arrays."""
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      flux[b, i] = _conservative_ks_flux(y[b, i], y_x[b, i], y_xxx[b, i])
+  _flux_divergence_kernel(flux, inv_dx, out)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_ks_stencil_kernel(y, coefficients, inv_dx, out):
+  """Fused ConservativeKSEquation.stencil_time_derivative on 2D arrays."""
+  padded = polynomials.periodic_pad(y, coefficients.shape[1])
+  flux = np.empty_like(out)
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      u = polynomials.stencil_sum(padded, coefficients, 0, b, i)
+      u_x = polynomials.stencil_sum(padded, coefficients, 1, b, i)
+      u_xxx = polynomials.stencil_sum(padded, coefficients, 2, b, i)
+      flux[b, i] = _conservative_ks_flux(u, u_x, u_xxx)
+  _flux_divergence_kernel(flux, inv_dx, out)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _conservative_stencil_kernel(y, kernel, coefficients, parameter, inv_dx,
+                                 out):
+  """Fused stencil_time_derivative on 2D arrays, for a given StencilKernel.
+
+  Kernels are selected by an integer rather than passed as jitted functions,
+  which would be compiled into callers as distinct types and prevent caching
+  them on disk.
+
+  Args:
+    y: array with dimensions [batch, x].
+    kernel: integer StencilKernel.
+    coefficients: stacked stencils with dimensions [derivative, stencil_size].
+    parameter: scalar parameter for the kernel, e.g., eta for Burgers.
+    inv_dx: inverse of the spacing between grid points.
+    out: array with dimensions [batch, x] in which to save the result.
+  """
+  if kernel == StencilKernel.BURGERS:
+    _conservative_burgers_stencil_kernel(
+        y, coefficients, parameter, inv_dx, out)
+  elif kernel == StencilKernel.KDV:
+    _conservative_kdv_stencil_kernel(y, coefficients, inv_dx, out)
+  elif kernel == StencilKernel.KS:
+    _conservative_ks_stencil_kernel(y, coefficients, inv_dx, out)
+  else:
+    raise ValueError('unknown stencil kernel')
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def conservative_spectral_radius(y, kernel, coefficients, parameter, inv_dx):
+  """Bound the spectral radius of the Jacobian of a fused stencil kernel.
+
+  By Gershgorin's theorem, the spectral radius is at most the largest absolute
+  row sum of the Jacobian. Each time derivative is the difference of two
+  fluxes, and each flux depends on `y` through stencil rows weighted by the
+  partial derivatives of the flux, which we bound using the maximum of |y|.
+
+  Args:
+    y: array with dimensions [batch, x] giving current function values.
+    kernel: integer StencilKernel, from Equation.stencil_kernel().
+    coefficients: stacked stencils with dimensions [derivative, stencil_size].
+    parameter: parameter for the kernel, from Equation.stencil_kernel().
+    inv_dx: inverse of the spacing between grid points.
+
+  Returns:
+    Upper bound on the magnitude of eigenvalues of the Jacobian, for choosing
+    stable time steps with explicit integrators.
+  """
+  max_abs_y = 0.0
+  for b in range(y.shape[0]):
+    for i in range(y.shape[1]):
+      max_abs_y = max(max_abs_y, abs(y[b, i]))
+  norms = np.zeros(coefficients.shape[0])
+  for row in range(coefficients.shape[0]):
+    for k in range(coefficients.shape[1]):
+      norms[row] += abs(coefficients[row, k])
+  # |y| bounds |u|, so the convective term contributes norms[0] twice
+  convective = norms[0] ** 2 * max_abs_y
+  if kernel == StencilKernel.BURGERS:
+    flux_norm = convective + abs(parameter) * norms[1]
+  elif kernel == StencilKernel.KDV:
+    flux_norm = 6 * convective + norms[1]
+  elif kernel == StencilKernel.KS:
+    flux_norm = convective + norms[1] + norms[2]
+  else:
+    raise ValueError('unknown stencil kernel')
+  return 2 * inv_dx * flux_norm
+
+
 class ConservativeKSEquation(KSEquation):
   """Conservative KS using Godunov numerical flux."""
 
@@ -562,10 +1046,16 @@ class ConservativeKSEquation(KSEquation):
     y = spatial_derivatives['u']
     y_x = spatial_derivatives['u_x']
     y_xxx = spatial_derivatives['u_xxx']
+    if isinstance(y, np.ndarray):
+      return _apply_kernel(_conservative_ks_kernel, [y, y_x, y_xxx],
+                           1 / self.grid.solution_dx)
     flux = 0.5*y**2 + y_xxx + y_x
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
 
+  def stencil_kernel(self) -> Tuple[StencilKernel, float]:
+    return StencilKernel.KS, 0.0
+
 
 class GodunovKSEquation(KSEquation):
   CONSERVATIVE = True
@@ -581,7 +1071,13 @@ class GodunovKSEquation(KSEquation):
     y_x = spatial_derivatives['u_x']
     y_xxx = spatial_derivatives['u_xxx']
 
-    convective_flux = godunov_convective_flux(y_minus, y_plus)
+    convective_flux = self._godunov_convective_flux(y_minus, y_plus)
+    if isinstance(convective_flux, np.ndarray):
+      flux = convective_flux
+      flux += y_xxx
+      flux += y_x
+      y_t = staggered_first_derivative(flux, self.grid.solution_dx)
+      return np.negative(y_t, out=y_t)
     flux = y_xxx + y_x + convective_flux
     y_t = -staggered_first_derivative(flux, self.grid.solution_dx)
     return y_t
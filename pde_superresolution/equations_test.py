@@ -23,6 +23,7 @@ import numpy as np
 import tensorflow as tf
 
 from pde_superresolution import equations  # pylint: disable=g-bad-import-order
+from pde_superresolution import polynomials  # pylint: disable=g-bad-import-order
 
 
 class GridTest(absltest.TestCase):
@@ -39,6 +40,25 @@ class GridTest(absltest.TestCase):
     np.testing.assert_equal(grid.reference_dx, 10)
 
 
+class RandomForcingTest(absltest.TestCase):
+
+  def test_forcing(self):
+    grid = equations.Grid(8, resample_factor=2, period=2 * np.pi)
+    forcing = equations.RandomForcing(grid, nparams=5, seed=1)
+    t = 0.3
+
+    signals = np.sin(forcing.omega * t
+                     + forcing.k * grid.reference_x
+                     + forcing.phi)
+    expected = grid.resample(np.sum(forcing.a * signals, axis=0))
+
+    np.testing.assert_allclose(forcing(t), expected)
+    with tf.Graph().as_default():
+      with tf.Session():
+        tf_result = forcing(tf.constant(t, dtype=tf.float64)).eval()
+    np.testing.assert_allclose(tf_result, expected)
+
+
 class EquationsTest(absltest.TestCase):
 
   def test_staggered_first_derivative_consistency(self):
@@ -51,6 +71,85 @@ class EquationsTest(absltest.TestCase):
             tf.constant(y), dx=1.0).eval()
     np.testing.assert_allclose(np_result, tf_result)
 
+  def test_staggered_first_derivative_batched(self):
+    y = np.random.RandomState(0).randn(3, 10)
+    actual = equations.staggered_first_derivative(y, dx=0.5)
+    expected = 2 * (np.roll(y, -1, axis=-1) - y)
+    np.testing.assert_allclose(actual, expected)
+
+  def test_equation_of_motion_consistency(self):
+    # NumPy fast paths should match the TensorFlow graph
+    random = np.random.RandomState(0)
+    equation_types = (list(equations.EQUATION_TYPES.values()) +
+                      list(equations.CONSERVATIVE_EQUATION_TYPES.values()) +
+                      list(equations.FLUX_EQUATION_TYPES.values()))
+    for equation_type in equation_types:
+      equation = equation_type(num_points=10)
+      y = random.randn(2, 10)
+      derivatives = {name: random.randn(2, 10)
+                     for name in equation.DERIVATIVE_NAMES}
+      np_result = equation.equation_of_motion(y, derivatives)
+      with tf.Graph().as_default():
+        with tf.Session():
+          tf_result = equation.equation_of_motion(
+              tf.constant(y),
+              {k: tf.constant(v) for k, v in derivatives.items()}).eval()
+      np.testing.assert_allclose(np_result, tf_result, err_msg=str(equation))
+
+  def test_equation_of_motion_broadcasting(self):
+    random = np.random.RandomState(0)
+    y = random.randn(2, 10)
+    derivatives = {'u_x': random.randn(10), 'u_xx': random.randn(10)}
+    equation = equations.BurgersEquation(num_points=10)
+    expected = equation.eta * derivatives['u_xx'] - y * derivatives['u_x']
+
+    actual = equation.equation_of_motion(y, derivatives)
+    np.testing.assert_allclose(actual, expected)
+
+    batched = {k: np.stack([v, v]) for k, v in derivatives.items()}
+    actual = equation.equation_of_motion(y[0], batched)
+    np.testing.assert_allclose(actual, expected[[0, 0]])
+
+  def test_conservative_spectral_radius(self):
+    for equation_type in equations.CONSERVATIVE_EQUATION_TYPES.values():
+      equation = equation_type(num_points=20)
+      coefficients = polynomials.stack_coefficients([
+          polynomials.coefficients(
+              polynomials.regular_grid(equation.GRID_OFFSET, order,
+                                       dx=equation.grid.solution_dx),
+              polynomials.Method.FINITE_VOLUMES, order)
+          for order in equation.DERIVATIVE_ORDERS])
+      y = np.random.RandomState(0).randn(20)
+
+      f0 = equation.stencil_time_derivative(y, coefficients)
+      jacobian = np.stack(
+          [equation.stencil_time_derivative(y + 1e-6 * e, coefficients) - f0
+           for e in np.eye(20)], axis=1) / 1e-6
+      actual = abs(np.linalg.eigvals(jacobian)).max()
+
+      kernel, parameter = equation.stencil_kernel()
+      bound = equations.conservative_spectral_radius(
+          y[np.newaxis, :], int(kernel), coefficients, parameter,
+          1 / equation.grid.solution_dx)
+      self.assertLessEqual(actual, bound, msg=str(equation))
+
+  def test_float32(self):
+    equation_types = (list(equations.CONSERVATIVE_EQUATION_TYPES.values()) +
+                      list(equations.FLUX_EQUATION_TYPES.values()))
+    for equation_type in equation_types:
+      equation = equation_type(num_points=10, dtype=np.float32)
+      self.assertEqual(equation.forcing(0.5).dtype, np.float32)
+      self.assertEqual(equation.initial_value().dtype, np.float32)
+
+      y = np.random.RandomState(0).randn(10).astype(np.float32)
+      coefficients = np.ones((len(equation.DERIVATIVE_NAMES), 2), np.float32)
+      y_t = equation.stencil_time_derivative(y, coefficients)
+      self.assertEqual(y_t.dtype, np.float32)
+
+      self.assertEqual(equation.params()['dtype'], np.float32)
+      self.assertEqual(equation.to_exact().dtype, np.float32)
+      self.assertEqual(equation.to_fine().dtype, np.float32)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -18,24 +18,38 @@ from __future__ import division
 from __future__ import print_function
 
 import functools
+import math
 import os
 
 from absl import logging
+import numba
 import numpy as np
 import scipy.fftpack
 import scipy.integrate
+import scipy.sparse
 import tensorflow as tf
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 import xarray
 from pde_superresolution import duckarray  # pylint: disable=g-bad-import-order
 from pde_superresolution import equations  # pylint: disable=g-bad-import-order
 from pde_superresolution import model  # pylint: disable=g-bad-import-order
+from pde_superresolution import polynomials  # pylint: disable=g-bad-import-order
 from pde_superresolution import training  # pylint: disable=g-bad-import-order
 from pde_superresolution import weno  # pylint: disable=g-bad-import-order
 
 
 _DEFAULT_TIMES = np.linspace(0, 10, num=201)
 
+# Name of the integration method without error control, which is handled by our
+# own jitted integrator rather than scipy.integrate.solve_ivp. It takes the
+# largest time steps that are stable for the current solution.
+FIXED_STEP_METHOD = 'SSPRK3'
+
+# Time steps for FIXED_STEP_METHOD, relative to the inverse of the bound from
+# equations.conservative_spectral_radius(). Integration becomes unstable for
+# KdV and KS around 3.0, because the bound is not tight.
+_SSPRK3_COURANT_NUMBER = 2.0
+
 
 class Differentiator(object):
   """Base class for calculating time derivatives."""
@@ -44,6 +58,136 @@ class Differentiator(object):
     """Calculate all desired spatial derivatives."""
     raise NotImplementedError
 
+  def integrate_fixed_step(
+      self, y0: np.ndarray, times: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Integrate with the jitted FIXED_STEP_METHOD, if supported.
+
+    Args:
+      y0: initial value, in the same format as passed to __call__.
+      times: times at which to save the solution.
+
+    Returns:
+      Tuple of the solution with dimensions [time, ...] and the number of
+      function evaluations.
+
+    Raises:
+      NotImplementedError: if this differentiator has no jitted equivalent.
+    """
+    raise NotImplementedError
+
+  def jacobian_sparsity(self) -> Optional[scipy.sparse.spmatrix]:
+    """Sparsity structure of the Jacobian for implicit solvers, if known."""
+    return None
+
+
+def periodic_band_sparsity(
+    num_points: int,
+    radius: int,
+    batch_size: int = 1) -> scipy.sparse.csr_matrix:
+  """Sparsity pattern for local stencils on a batch of periodic grids.
+
+  Args:
+    num_points: number of grid points in each equation.
+    radius: maximum distance between points that depend on each other.
+    batch_size: number of independent equations in the flattened state.
+
+  Returns:
+    Sparse matrix with shape (batch_size*num_points, batch_size*num_points),
+    with non-zero entries for all pairs of points within `radius` of each other
+    (wrapping around the periodic boundary) in the same equation.
+  """
+  offsets = np.arange(-radius, radius + 1)
+  rows = np.repeat(np.arange(num_points), offsets.size)
+  cols = (rows + np.tile(offsets, num_points)) % num_points
+  block = scipy.sparse.csr_matrix(
+      (np.ones(rows.size, dtype=bool), (rows, cols)),
+      shape=(num_points, num_points))
+  return scipy.sparse.block_diag([block] * batch_size, format='csr')
+
+
+def _stencil_radius(equation: equations.Equation,
+                    coefficients: np.ndarray) -> int:
+  """Maximum distance between points coupled by fixed stencils."""
+  radius = coefficients.shape[-1] // 2
+  if equation.CONSERVATIVE:
+    # time derivatives are differences of fluxes on both cell boundaries
+    radius += 1
+  return radius
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _ssprk3_kernel(y0, times, courant_number, kernel, coefficients, parameter,
+                   inv_dx, amplitude, omega, basis, out):
+  """Third order strong stability preserving Runge-Kutta (Shu-Osher) loop."""
+  batch_size, num_points = y0.shape
+  y = y0.copy()
+  y_stage = np.empty_like(y)
+  y_t = np.empty_like(y)
+  out[0] = y
+  num_evals = 0
+  for n in range(1, times.size):
+    t = times[n - 1]
+    last_step = False
+    while not last_step:
+      # time steps adapt to the current solution, but stop exactly at times[n]
+      radius = equations.conservative_spectral_radius(
+          y, kernel, coefficients, parameter, inv_dx)
+      dt = times[n] - t
+      if courant_number < radius * dt:
+        dt = courant_number / radius
+      else:
+        last_step = True
+      equations.conservative_time_derivative(
+          t, y, kernel, coefficients, parameter, inv_dx,
+          amplitude, omega, basis, y_t)
+      for b in range(batch_size):
+        for i in range(num_points):
+          y_stage[b, i] = y[b, i] + dt * y_t[b, i]
+      equations.conservative_time_derivative(
+          t + dt, y_stage, kernel, coefficients, parameter, inv_dx,
+          amplitude, omega, basis, y_t)
+      for b in range(batch_size):
+        for i in range(num_points):
+          y_stage[b, i] = (0.75 * y[b, i]
+                           + 0.25 * (y_stage[b, i] + dt * y_t[b, i]))
+      equations.conservative_time_derivative(
+          t + 0.5 * dt, y_stage, kernel, coefficients, parameter, inv_dx,
+          amplitude, omega, basis, y_t)
+      for b in range(batch_size):
+        for i in range(num_points):
+          y[b, i] = (y[b, i] + 2 * (y_stage[b, i] + dt * y_t[b, i])) / 3
+      num_evals += 3
+      t += dt
+    out[n] = y
+  return num_evals
+
+
+def _integrate_ssprk3(
+    equations_batch: List[equations.Equation],
+    coefficients: np.ndarray,
+    y0: np.ndarray,
+    times: np.ndarray,
+    courant_number: float = _SSPRK3_COURANT_NUMBER,
+) -> Tuple[np.ndarray, int]:
+  """Integrate a batch of conservative equations with fixed stencils."""
+  equation = equations_batch[0]
+  stencil_kernel = equation.stencil_kernel()
+  if stencil_kernel is None:
+    raise NotImplementedError(
+        'no stencil kernel for {}'.format(type(equation).__name__))
+  kernel, parameter = stencil_kernel
+  amplitude, omega, basis = [
+      np.stack(terms) for terms in
+      zip(*[eq.forcing_terms() for eq in equations_batch])]
+  y0 = y0.astype(equation.dtype).reshape(len(equations_batch), -1)
+  out = np.empty((times.size,) + y0.shape, equation.dtype)
+  inv_dx = equation.dtype.type(1 / equation.grid.solution_dx)
+  num_evals = _ssprk3_kernel(
+      y0, times.astype(np.float64), courant_number, int(kernel),
+      coefficients, equation.dtype.type(parameter), inv_dx, amplitude, omega,
+      basis, out)
+  return out, num_evals
+
 
 class SavedModelDifferentiator(Differentiator):
   """Calculate derivatives from a saved TensorFlow model."""
@@ -77,7 +221,17 @@ class PolynomialDifferentiator(Differentiator):
   def __init__(self,
                equation: equations.Equation,
                accuracy_order: Optional[int] = 1):
+    self.equation = equation
+
+    if accuracy_order is not None:
+      # Stencils with an explicit accuracy order are fixed, so we evaluate them
+      # with fused NumPy kernels rather than running a TensorFlow session for
+      # every function evaluation.
+      self.coefficients = model.baseline_coefficients(
+          equation, accuracy_order).astype(equation.dtype)
+      return
 
+    self.coefficients = None
     with tf.Graph().as_default():
       self.t = tf.placeholder(tf.float32, shape=())
 
@@ -99,12 +253,80 @@ class PolynomialDifferentiator(Differentiator):
       self.sess = tf.Session()
 
   def __call__(self, t: float, y: np.ndarray) -> np.ndarray:
+    if self.coefficients is not None:
+      # solve_ivp keeps its state in float64, so casting y to a float32 dtype
+      # would only add a conversion to every call. Reduced precision takes
+      # effect end to end with integrate_fixed_step() instead.
+      time_derivative = self.equation.stencil_time_derivative(
+          y, self.coefficients)
+      return self.equation.finalize_time_derivative(t, time_derivative)
     return self.sess.run(self.value, feed_dict={self.t: t, self.inputs: y})
 
+  def integrate_fixed_step(self, y0, times):
+    if self.coefficients is None:
+      raise NotImplementedError
+    y, num_evals = _integrate_ssprk3(
+        [self.equation], self.coefficients, y0, times)
+    return y[:, 0, :], num_evals
+
+  def jacobian_sparsity(self):
+    if self.coefficients is None:
+      return None
+    radius = _stencil_radius(self.equation, self.coefficients)
+    return periodic_band_sparsity(
+        self.equation.grid.solution_num_points, radius)
+
   def calculate_space_derivatives(self, y):
+    if self.coefficients is not None:
+      derivatives = polynomials.apply_stencils(y, self.coefficients)
+      return dict(zip(self.equation.DERIVATIVE_NAMES, derivatives))
     return self.sess.run(self._space_derivatives, feed_dict={self.inputs: y})
 
 
+class BatchPolynomialDifferentiator(Differentiator):
+  """Standard finite differences for a batch of equations at once.
+
+  Equations must share the same type and parameters, except for random seeds.
+  The state is a flattened array holding one solution per equation.
+  """
+
+  def __init__(self,
+               equations_batch: List[equations.Equation],
+               accuracy_order: int = 1):
+    equation = equations_batch[0]
+    params = dict(equation.params(), random_seed=None)
+    for other in equations_batch[1:]:
+      if (type(other) is not type(equation)
+          or dict(other.params(), random_seed=None) != params):
+        raise ValueError('equations can only differ by random_seed: {} vs {}'
+                         .format(equation, other))
+
+    self.equations = equations_batch
+    self.coefficients = model.baseline_coefficients(
+        equation, accuracy_order).astype(equation.dtype)
+    self.shape = (len(equations_batch), equation.grid.solution_num_points)
+
+  def __call__(self, t: float, y: np.ndarray) -> np.ndarray:
+    # as in PolynomialDifferentiator, y keeps the dtype used by solve_ivp
+    y = y.reshape(self.shape)
+    # spatial derivatives are calculated for the whole batch in one pass
+    time_derivative = self.equations[0].stencil_time_derivative(
+        y, self.coefficients)
+    finalized = [equation.finalize_time_derivative(t, y_t)
+                 for equation, y_t in zip(self.equations, time_derivative)]
+    return np.concatenate(finalized)
+
+  def integrate_fixed_step(self, y0, times):
+    y, num_evals = _integrate_ssprk3(
+        self.equations, self.coefficients, y0, times)
+    return y.reshape(times.size, -1), num_evals
+
+  def jacobian_sparsity(self):
+    batch_size, num_points = self.shape
+    radius = _stencil_radius(self.equations[0], self.coefficients)
+    return periodic_band_sparsity(num_points, radius, batch_size)
+
+
 class SpectralDifferentiator(Differentiator):
   """Calculate derivatives using a spectral method."""
 
@@ -145,14 +367,33 @@ def odeint(y0: np.ndarray,
            times: np.ndarray,
            method: str = 'RK23') -> Tuple[np.ndarray, int]:
   """Integrate an ODE."""
+  if method == FIXED_STEP_METHOD:
+    try:
+      logging.info('%s from %s to %s', method, times[0], times[-1])
+      return differentiator.integrate_fixed_step(y0, times)
+    except NotImplementedError:
+      logging.info('%s not supported by %r, falling back to RK23',
+                   method, differentiator)
+      method = 'RK23'
+
   logging.info('solve_ivp from %s to %s', times[0], times[-1])
 
   # Most of our equations are somewhat stiff, so lower order Runga-Kutta is a
   # sane default. For whatever reason, the stiff solvers are much slower when
   # using TensorFlow to compute derivatives (even the baseline model) than
   # when using NumPy.
+  options = {}
+  if method in ('BDF', 'Radau'):
+    # With a known sparsity structure, finite difference Jacobians only need
+    # one function evaluation per group of independent columns, rather than
+    # one per column. (LSODA only supports contiguous bands, which periodic
+    # boundary conditions rule out.)
+    jac_sparsity = differentiator.jacobian_sparsity()
+    if jac_sparsity is not None:
+      options['jac_sparsity'] = jac_sparsity
   sol = scipy.integrate.solve_ivp(differentiator, (times[0], times[-1]), y0,
-                                  t_eval=times, max_step=0.01, method=method)
+                                  t_eval=times, max_step=0.01, method=method,
+                                  **options)
   y = sol.y.T  # (time, x)
 
   logging.info('nfev: %r, njev: %r, nlu: %r', sol.nfev, sol.njev, sol.nlu)
@@ -235,25 +476,27 @@ def exact_differentiator(
   return differentiator
 
 
-def integrate(
+def _warmup_odeint(
     equation: equations.Equation,
-    differentiator: Differentiator,
-    times: np.ndarray = _DEFAULT_TIMES,
-    warmup: float = 0,
-    integrate_method: str = 'RK23',
-    filter_interval: float = None,
-    filter_all_times: bool = False) -> xarray.Dataset:
-  """Integrate an equation with possible warmup or periodic filtering."""
-
+    filter_interval: Optional[float]) -> Callable[..., Tuple[np.ndarray, int]]:
+  """Return the odeint function to use for warmup."""
   if filter_interval is not None:
-    warmup_odeint = functools.partial(
+    return functools.partial(
         odeint_with_periodic_filtering,
         filter_interval=filter_interval,
         filter_order=max(equation.to_exact().DERIVATIVE_ORDERS))
   else:
-    warmup_odeint = odeint
+    return odeint
 
+
+def _initial_value(
+    equation: equations.Equation,
+    warmup: float = 0,
+    integrate_method: str = 'RK23',
+    filter_interval: float = None) -> np.ndarray:
+  """Initial value for integration, possibly after warmup."""
   if warmup:
+    warmup_odeint = _warmup_odeint(equation, filter_interval)
     equation_exact = equation.to_exact()
     diff_exact = exact_differentiator(equation_exact)
     if filter_interval is not None:
@@ -267,8 +510,24 @@ def integrate(
     y0 = equation.grid.resample(solution_warmup[-1, :])
   else:
     y0 = equation.initial_value()
+  return y0
 
-  odeint_func = warmup_odeint if filter_all_times else odeint
+
+def integrate(
+    equation: equations.Equation,
+    differentiator: Differentiator,
+    times: np.ndarray = _DEFAULT_TIMES,
+    warmup: float = 0,
+    integrate_method: str = 'RK23',
+    filter_interval: float = None,
+    filter_all_times: bool = False) -> xarray.Dataset:
+  """Integrate an equation with possible warmup or periodic filtering."""
+  y0 = _initial_value(equation, warmup, integrate_method, filter_interval)
+
+  if filter_all_times:
+    odeint_func = _warmup_odeint(equation, filter_interval)
+  else:
+    odeint_func = odeint
   solution, num_evals = odeint_func(
       y0, differentiator, times=warmup+times, method=integrate_method)
 
@@ -308,6 +567,50 @@ def integrate_baseline(
                    filter_interval=exact_filter_interval)
 
 
+def integrate_baseline_batch(
+    equations_batch: List[equations.Equation],
+    times: np.ndarray = _DEFAULT_TIMES,
+    warmup: float = 0,
+    accuracy_order: int = 1,
+    integrate_method: str = 'RK23',
+    exact_filter_interval: float = None) -> List[xarray.Dataset]:
+  """Integrate a batch of baseline finite difference models together.
+
+  This is equivalent to calling integrate_baseline() on each equation, except
+  all solutions are advanced by a single solver (with shared time steps).
+
+  Args:
+    equations_batch: equations to integrate, differing only by random seed.
+    times: times at which to save the solution.
+    warmup: amount of time to integrate before saving the solution.
+    accuracy_order: integer order of polynomial accuracy for finite
+      differences.
+    integrate_method: method to use with scipy.integrate.solve_ivp, or
+      FIXED_STEP_METHOD.
+    exact_filter_interval: interval between periodic filtering during warmup.
+
+  Returns:
+    List of datasets, in the same format as integrate_baseline(), with one
+    dataset per equation. num_evals counts evaluations for the whole batch.
+  """
+  differentiator = BatchPolynomialDifferentiator(
+      equations_batch, accuracy_order=accuracy_order)
+  y0 = np.concatenate([
+      _initial_value(equation, warmup, integrate_method, exact_filter_interval)
+      for equation in equations_batch])
+  solution, num_evals = odeint(
+      y0, differentiator, times=warmup+times, method=integrate_method)
+  solution = solution.reshape((solution.shape[0],) + differentiator.shape)
+
+  results = []
+  for i, equation in enumerate(equations_batch):
+    results.append(xarray.Dataset(
+        data_vars={'y': (('time', 'x'), solution[:, i, :])},
+        coords={'time': warmup+times, 'x': equation.grid.solution_x,
+                'num_evals': num_evals}))
+  return results
+
+
 def integrate_weno(
     equation: equations.Equation,
     times: np.ndarray = _DEFAULT_TIMES,
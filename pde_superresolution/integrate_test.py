@@ -31,6 +31,7 @@ import xarray
 from pde_superresolution import duckarray  # pylint: disable=g-bad-import-order
 from pde_superresolution import equations  # pylint: disable=g-bad-import-order
 from pde_superresolution import integrate  # pylint: disable=g-bad-import-order
+from pde_superresolution import model  # pylint: disable=g-bad-import-order
 from pde_superresolution import training  # pylint: disable=g-bad-import-order
 from pde_superresolution import weno  # pylint: disable=g-bad-import-order
 
@@ -184,6 +185,87 @@ class IntegrateTest(parameterized.TestCase):
     xarray.testing.assert_allclose(
         y_mean, xarray.zeros_like(y_mean), atol=1e-3)
 
+  @parameterized.parameters(
+      dict(equation=equations.BurgersEquation(200)),
+      dict(equation=equations.ConservativeBurgersEquation(200)),
+      dict(equation=equations.KdVEquation(200)),
+      dict(equation=equations.ConservativeKdVEquation(200)),
+      dict(equation=equations.KSEquation(200)),
+      dict(equation=equations.ConservativeKSEquation(200)),
+      dict(equation=equations.GodunovKSEquation(200), accuracy_order=3),
+  )
+  def test_polynomial_differentiator_matches_tensorflow(
+      self, equation, accuracy_order=1):
+    y = 0.1 * np.random.RandomState(0).randn(200)
+    differentiator = integrate.PolynomialDifferentiator(
+        equation, accuracy_order=accuracy_order)
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(y[np.newaxis, :], dtype=tf.float32)
+      space_derivatives = model.baseline_space_derivatives(
+          inputs, equation, accuracy_order=accuracy_order)
+      time_derivative = model.apply_space_derivatives(
+          space_derivatives, inputs, equation)
+      with tf.Session() as sess:
+        expected = sess.run(time_derivative)[0]
+
+    actual = equation.stencil_time_derivative(
+        y, differentiator.coefficients)
+    np.testing.assert_allclose(actual, expected, rtol=1e-3, atol=1e-3)
+
+  def test_integrate_baseline_batch(self):
+    times = np.linspace(0, 1, num=11)
+    equations_batch = [equations.ConservativeBurgersEquation(200, random_seed=i)
+                       for i in range(3)]
+    results = integrate.integrate_baseline_batch(equations_batch, times=times)
+    self.assertEqual(len(results), 3)
+    for equation, result in zip(equations_batch, results):
+      expected = integrate.integrate_baseline(equation, times=times)
+      np.testing.assert_allclose(
+          result['y'].data, expected['y'].data, atol=1e-5)
+
+  def test_integrate_baseline_fixed_step(self):
+    times = np.linspace(0, 1, num=11)
+    equations_batch = [equations.ConservativeBurgersEquation(200, random_seed=i)
+                       for i in range(2)]
+    results = integrate.integrate_baseline_batch(
+        equations_batch, times=times,
+        integrate_method=integrate.FIXED_STEP_METHOD)
+    for equation, result in zip(equations_batch, results):
+      expected = integrate.integrate_baseline(equation, times=times)
+      np.testing.assert_allclose(
+          result['y'].data, expected['y'].data, atol=1e-3)
+
+  @parameterized.parameters(
+      dict(integrate_method='RK23', atol=1e-6),
+      dict(integrate_method=integrate.FIXED_STEP_METHOD, atol=1e-5),
+  )
+  def test_integrate_baseline_float32(self, integrate_method, atol):
+    times = np.linspace(0, 1, num=11)
+    results = {}
+    for dtype in [np.float32, np.float64]:
+      equation = equations.ConservativeBurgersEquation(200, dtype=dtype)
+      results[dtype] = integrate.integrate_baseline(
+          equation, times=times, integrate_method=integrate_method)
+    np.testing.assert_allclose(results[np.float32]['y'].data,
+                               results[np.float64]['y'].data, atol=atol)
+
+  @parameterized.parameters(
+      dict(equation=equations.ConservativeBurgersEquation(20)),
+      dict(equation=equations.ConservativeKSEquation(20), accuracy_order=3),
+      dict(equation=equations.KdVEquation(20)),
+  )
+  def test_jacobian_sparsity(self, equation, accuracy_order=1):
+    differentiator = integrate.PolynomialDifferentiator(
+        equation, accuracy_order=accuracy_order)
+    y0 = np.random.RandomState(0).randn(equation.grid.solution_num_points)
+    f0 = differentiator(0, y0)
+    jacobian = np.stack([differentiator(0, y0 + 1e-6 * e) - f0
+                         for e in np.eye(y0.size)], axis=1)
+    sparsity = differentiator.jacobian_sparsity().toarray()
+    self.assertFalse(((jacobian != 0) & ~sparsity).any())
+    self.assertFalse(sparsity.all())
+
   @parameterized.parameters(
       dict(equation=equations.GodunovBurgersEquation(200)),
       dict(equation=equations.GodunovKdVEquation(200), tol=5e-3),
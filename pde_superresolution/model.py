@@ -112,6 +112,31 @@ def baseline_space_derivatives(
   return tf.stack(spatial_derivatives_list, axis=-1)
 
 
+def baseline_coefficients(
+    equation: equations.Equation, accuracy_order: int) -> np.ndarray:
+  """Finite difference coefficients used by baseline_space_derivatives().
+
+  Args:
+    equation: equation being solved.
+    accuracy_order: integer order of polynomial accuracy to enforce.
+
+  Returns:
+    NumPy array with dimensions [derivative, stencil_size] giving stacked
+    coefficients for each of equation.DERIVATIVE_NAMES, for use with
+    polynomials.apply_stencils().
+  """
+  method = FINITE_VOL if equation.CONSERVATIVE else FINITE_DIFF
+  stencils = []
+  for derivative_order in equation.DERIVATIVE_ORDERS:
+    grid = polynomials.regular_grid(
+        grid_offset=equation.GRID_OFFSET,
+        derivative_order=derivative_order,
+        accuracy_order=accuracy_order,
+        dx=equation.grid.solution_dx)
+    stencils.append(polynomials.coefficients(grid, method, derivative_order))
+  return polynomials.stack_coefficients(stencils)
+
+
 def apply_space_derivatives(
     derivatives: tf.Tensor,
     inputs: tf.Tensor,
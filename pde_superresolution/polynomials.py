@@ -20,10 +20,11 @@ from __future__ import print_function
 
 import enum
 
+import numba
 import numpy as np
 import scipy.special
 import tensorflow as tf
-from typing import Tuple
+from typing import List, Tuple
 
 from pde_superresolution import layers  # pylint: disable=g-bad-import-order
 
@@ -301,3 +302,105 @@ def reconstruct(
       inputs[..., tf.newaxis], filters[..., tf.newaxis, tf.newaxis],
       stride=1, center=True)
   return tf.squeeze(convolved, axis=2)
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def periodic_pad(inputs, stencil_size):
+  """Periodically pad a 2D array for applying stencils with stencil_sum().
+
+  Args:
+    inputs: array with dimensions [batch, x].
+    stencil_size: size of the stencils that will be applied.
+
+  Returns:
+    Array with dimensions [batch, x + stencil_size - 1], where position i holds
+    inputs[:, (i - stencil_size // 2) % x].
+  """
+  batch_size, num_points = inputs.shape
+  left = stencil_size // 2
+  right = stencil_size - 1 - left
+  padded = np.empty((batch_size, num_points + stencil_size - 1), inputs.dtype)
+  for batch in range(batch_size):
+    # only the few padding entries need to wrap around
+    for index in range(left):
+      padded[batch, index] = inputs[batch, (index - left) % num_points]
+    for index in range(num_points):
+      padded[batch, left + index] = inputs[batch, index]
+    for index in range(right):
+      padded[batch, left + num_points + index] = inputs[batch,
+                                                        index % num_points]
+  return padded
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def stencil_sum(padded, coefficients, row, batch, index):
+  """Apply one row of stacked stencils at a single position of a 2D array.
+
+  Args:
+    padded: array with dimensions [batch, x + stencil_size - 1], from
+      periodic_pad().
+    coefficients: array with dimensions [stencil_row, stencil_size], aligned as
+      described in apply_stencils().
+    row: integer row of `coefficients` to apply.
+    batch: integer index along the batch dimension of `padded`.
+    index: integer index along the x dimension of the unpadded inputs.
+
+  Returns:
+    Scalar finite difference approximation.
+  """
+  # start from the first term, so the sum keeps the dtype of the inputs
+  total = coefficients[row, 0] * padded[batch, index]
+  for k in range(1, coefficients.shape[1]):
+    total += coefficients[row, k] * padded[batch, index + k]
+  return total
+
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _apply_stencils_kernel(inputs, coefficients, out):
+  padded = periodic_pad(inputs, coefficients.shape[1])
+  for row in range(coefficients.shape[0]):
+    for batch in range(inputs.shape[0]):
+      for index in range(inputs.shape[1]):
+        out[row, batch, index] = stencil_sum(
+            padded, coefficients, row, batch, index)
+
+
+def stack_coefficients(stencils: List[np.ndarray]) -> np.ndarray:
+  """Stack finite difference stencils of different sizes, padding with zeros.
+
+  Args:
+    stencils: list of 1D coefficient arrays, e.g., from coefficients(). Sizes
+      must all be even or all be odd, as they are for stencils on the same
+      type of grid.
+
+  Returns:
+    NumPy array with dimensions [len(stencils), max_size], where each stencil
+    has been padded with an equal number of zeros on either side.
+  """
+  size = max(stencil.size for stencil in stencils)
+  return np.stack([np.pad(stencil, (size - stencil.size) // 2,
+                          mode='constant')
+                   for stencil in stencils])
+
+
+def apply_stencils(inputs: np.ndarray, coefficients: np.ndarray) -> np.ndarray:
+  """Calculate finite differences with fixed stencils on NumPy arrays.
+
+  This is the NumPy counterpart of reconstruct(), evaluating several stacked
+  stencils at once with periodic boundary conditions.
+
+  Args:
+    inputs: np.ndarray with dimensions [..., x].
+    coefficients: np.ndarray with dimensions [stencil_row, stencil_size], e.g.,
+      from stack_coefficients(). As in reconstruct(), position i in each result
+      is calculated from inputs at positions i - stencil_size // 2 through
+      i - stencil_size // 2 + stencil_size - 1.
+
+  Returns:
+    np.ndarray with dimensions [stencil_row, ..., x].
+  """
+  inputs_2d = inputs.reshape(-1, inputs.shape[-1])
+  out = np.empty((coefficients.shape[0],) + inputs_2d.shape,
+                 dtype=np.result_type(inputs, coefficients))
+  _apply_stencils_kernel(inputs_2d, coefficients, out)
+  return out.reshape((coefficients.shape[0],) + inputs.shape)
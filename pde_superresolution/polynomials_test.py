@@ -21,6 +21,7 @@ from __future__ import print_function
 from absl.testing import absltest  # pylint: disable=g-bad-import-order
 from absl.testing import parameterized
 import numpy as np
+import tensorflow as tf
 
 from pde_superresolution import polynomials
 
@@ -156,5 +157,69 @@ class PolynomialsTest(parameterized.TestCase):
         grid_offset, derivative_order, accuracy_order)
     np.testing.assert_allclose(actual_grid, expected_grid)
 
+  @parameterized.parameters(
+      dict(stencils=[[1], [1, -2, 1]],
+           expected=[[0, 1, 0], [1, -2, 1]]),
+      dict(stencils=[[0.5, 0.5], [-1, 1], [1, -1, -1, 1]],
+           expected=[[0, 0.5, 0.5, 0], [0, -1, 1, 0], [1, -1, -1, 1]]),
+  )
+  def test_stack_coefficients(self, stencils, expected):
+    actual = polynomials.stack_coefficients(
+        [np.array(stencil, dtype=float) for stencil in stencils])
+    np.testing.assert_array_equal(actual, expected)
+
+  @parameterized.parameters(
+      dict(stencil_size=1),
+      dict(stencil_size=4),
+      dict(stencil_size=5),
+  )
+  def test_periodic_pad(self, stencil_size):
+    inputs = np.random.RandomState(0).randn(3, 10)
+    actual = polynomials.periodic_pad(inputs, stencil_size)
+    left = stencil_size // 2
+    expected = np.pad(inputs, [(0, 0), (left, stencil_size - 1 - left)],
+                      mode='wrap')
+    np.testing.assert_array_equal(actual, expected)
+
+  @parameterized.parameters(
+      dict(grid_offset=polynomials.GridOffset.CENTERED, method=FINITE_DIFF,
+           derivative_orders=(1, 2, 3)),
+      dict(grid_offset=polynomials.GridOffset.STAGGERED, method=FINITE_VOL,
+           derivative_orders=(0, 1, 2)),
+  )
+  def test_apply_stencils(self, grid_offset, method, derivative_orders):
+    stencils = [
+        polynomials.coefficients(
+            polynomials.regular_grid(grid_offset, order, accuracy_order=1),
+            method, order)
+        for order in derivative_orders]
+    self.assertGreater(len({stencil.size for stencil in stencils}), 1)
+    coefficients = polynomials.stack_coefficients(stencils)
+
+    inputs = np.random.RandomState(0).randn(2, 3, 10)
+    actual = polynomials.apply_stencils(inputs, coefficients)
+    self.assertEqual(actual.shape, (len(stencils), 2, 3, 10))
+
+    # compare to reconstruct() with unpadded stencils
+    with tf.Graph().as_default():
+      with tf.Session():
+        for i, order in enumerate(derivative_orders):
+          grid = polynomials.regular_grid(grid_offset, order, accuracy_order=1)
+          expected = polynomials.reconstruct(
+              tf.constant(inputs.reshape(6, 10), tf.float32),
+              grid, method, order).eval()
+          np.testing.assert_allclose(
+              actual[i].reshape(6, 10), expected, rtol=1e-5, atol=1e-5)
+
+    # stencil_sum() evaluates single entries of the same result
+    padded = polynomials.periodic_pad(inputs.reshape(6, 10),
+                                      coefficients.shape[1])
+    for row, batch, index in [(0, 0, 0), (1, 2, 9), (2, 5, 4)]:
+      single = polynomials.stencil_sum(
+          padded, coefficients, row, batch, index)
+      self.assertAlmostEqual(
+          single, actual[row].reshape(6, 10)[batch, index])
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -17,15 +17,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import concurrent.futures
+import fcntl
 import json
+import os
+import shutil
+import tempfile
 
 from absl import app
 from absl import flags
 import apache_beam as beam
+import netCDF4
 import numpy as np
+import tensorflow as tf
 from pde_superresolution import equations
 from pde_superresolution import integrate
-from pde_superresolution import xarray_beam
 
 
 # NOTE(shoyer): allow_override=True lets us import multiple binaries for the
@@ -48,6 +54,11 @@ flags.DEFINE_string(
 flags.DEFINE_integer(
     'num_samples', 10,
     'Number of times to integrate each equation.', allow_override=True)
+flags.DEFINE_integer(
+    'batch_size', 1,
+    'Number of samples to integrate together with a single solver. Larger '
+    'batches amortize solver overhead, but share adaptive time steps.',
+    allow_override=True)
 
 # integrate parameters
 flags.DEFINE_float(
@@ -68,23 +79,113 @@ flags.DEFINE_float(
     allow_override=True)
 flags.DEFINE_string(
     'integrate_method', 'RK23',
-    'Method to use for integration with scipy.integrate.solve_ivp.',
+    'Method to use for integration with scipy.integrate.solve_ivp, or '
+    "'SSPRK3' for a jitted integrator with time steps chosen for stability "
+    "rather than accuracy. The implicit 'BDF' and 'Radau' methods use the "
+    'sparsity of finite difference stencils, which can be much faster for '
+    'stiff equations like KS.',
     allow_override=True)
 flags.DEFINE_float(
     'exact_filter_interval', 0,
     'Interval between periodic filtering. Only used for spectral methods.',
     allow_override=True)
+flags.DEFINE_enum(
+    'dtype', 'float64', ['float32', 'float64'],
+    'Floating point precision for the SSPRK3 integrate_method, which keeps '
+    'its state in this precision. scipy.integrate.solve_ivp always '
+    'integrates in float64, where float32 would only add conversions. KdV '
+    'always uses float64, because its third derivative term is too sensitive '
+    'to round-off for float32.',
+    allow_override=True)
+
+# pipeline parameters
+flags.DEFINE_integer(
+    'num_workers', None,
+    'Number of worker processes to use with the default DirectRunner. '
+    'Defaults to the number of CPUs.',
+    allow_override=True)
+flags.DEFINE_integer(
+    'num_threads', 1,
+    'Number of threads each worker uses to run integrations concurrently. '
+    'Jitted kernels release the GIL, so this is most effective with the '
+    'SSPRK3 integrate_method.',
+    allow_override=True)
 
 
 FLAGS = flags.FLAGS
 
 
+class ThreadPoolFlatMap(beam.DoFn):
+  """FlatMap a function over batches of elements using a thread pool."""
+
+  def __init__(self, fn, num_threads):
+    self.fn = fn
+    self.num_threads = num_threads
+    self._executor = None
+
+  def setup(self):
+    self._executor = concurrent.futures.ThreadPoolExecutor(self.num_threads)
+
+  def process(self, elements):
+    for results in self._executor.map(lambda x: list(self.fn(x)), elements):
+      for result in results:
+        yield result
+
+  def teardown(self):
+    self._executor.shutdown()
+
+
+def create_output_file(path, samples, accuracy_orders, time, x):
+  """Create a netCDF file with space for all results from write_result()."""
+  with netCDF4.Dataset(path, 'w') as ds:
+    coords = [('sample', samples), ('accuracy_order', accuracy_orders),
+              ('time', time), ('x', x)]
+    for name, values in coords:
+      values = np.asarray(values)
+      ds.createDimension(name, values.size)
+      ds.createVariable(name, values.dtype, (name,))[:] = values
+    dims = ('sample', 'accuracy_order', 'time', 'x')
+    y = ds.createVariable('y', np.float32, dims, fill_value=np.nan)
+    # decoded by xarray as a coordinate, like other integration results
+    y.coordinates = 'num_evals'
+    ds.createVariable('num_evals', np.int64, ('sample', 'accuracy_order'),
+                      fill_value=False)
+
+
+def write_result(path, sample_index, accuracy_index, y, num_evals):
+  """Write one integration result into a file from create_output_file()."""
+  # workers may run in separate processes or threads, but the netCDF library
+  # does not support concurrent writes to the same file
+  with open(path + '.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    with netCDF4.Dataset(path, 'a') as ds:
+      ds['y'][sample_index, accuracy_index] = y
+      ds['num_evals'][sample_index, accuracy_index] = num_evals
+
+
 def main(_, runner=None):
   if runner is None:
     # must create before flags are used
     runner = beam.runners.DirectRunner()
+    # every (seed, accuracy_order) integration is independent, so run them
+    # in separate processes to avoid contention on the GIL. Functions sent to
+    # worker processes refer to this module's globals, which need to be
+    # pickled when it runs as __main__.
+    options = beam.options.pipeline_options.PipelineOptions(
+        direct_num_workers=FLAGS.num_workers or os.cpu_count(),
+        direct_running_mode='multi_processing',
+        save_main_session=True)
+  elif not isinstance(runner, beam.runners.DirectRunner):
+    # workers write results into a temporary file on this machine
+    raise ValueError('create_baseline_data requires a local DirectRunner, not '
+                     '{!r}'.format(runner))
+  else:
+    options = None
 
   equation_kwargs = json.loads(FLAGS.equation_kwargs)
+  if (FLAGS.equation_name != 'kdv'
+      and FLAGS.integrate_method == integrate.FIXED_STEP_METHOD):
+    equation_kwargs['dtype'] = FLAGS.dtype
   accuracy_orders = FLAGS.accuracy_orders
 
   if (equations.EQUATION_TYPES[FLAGS.equation_name].EXACT_METHOD
@@ -97,37 +198,62 @@ def main(_, runner=None):
     equation_type = equations.CONSERVATIVE_EQUATION_TYPES[name]
     return equation_type(random_seed=seed, **kwargs)
 
+  times = np.arange(0, FLAGS.time_max + FLAGS.time_delta, FLAGS.time_delta)
+
   def integrate_baseline(
-      equation, accuracy_order,
-      times=np.arange(0, FLAGS.time_max + FLAGS.time_delta, FLAGS.time_delta),
+      equations_batch, accuracy_order,
+      times=times,
       warmup=FLAGS.warmup,
       integrate_method=FLAGS.integrate_method,
       exact_filter_interval=exact_filter_interval):
-    return integrate.integrate_baseline(
-        equation, times, warmup, accuracy_order, integrate_method,
-        exact_filter_interval).astype(np.float32)
-
-  def create_equation_and_integrate(seed_and_accuracy_order):
-    seed, accuracy_order = seed_and_accuracy_order
-    equation = create_equation(seed)
-    assert equation.CONSERVATIVE
-    result = integrate_baseline(equation, accuracy_order)
-    result.coords['sample'] = seed
-    result.coords['accuracy_order'] = accuracy_order
-    return (seed, result)
+    results = integrate.integrate_baseline_batch(
+        equations_batch, times, warmup, accuracy_order, integrate_method,
+        exact_filter_interval)
+    return [(result['y'].data.astype(np.float32), int(result['num_evals']))
+            for result in results]
+
+  # Each result is written into a preallocated file as soon as its
+  # integration finishes, rather than combining results in memory. Workers
+  # write to the same local file, so this requires a runner on a single
+  # machine.
+  tmp_dir = tempfile.mkdtemp()
+  local_path = os.path.join(tmp_dir, 'results.nc')
+  sorted_accuracy_orders = sorted(set(accuracy_orders))
+
+  def integrate_and_write(seeds_equations_and_accuracy_order,
+                          path=local_path,
+                          accuracy_orders=sorted_accuracy_orders):
+    seeds, equations_batch, accuracy_order = seeds_equations_and_accuracy_order
+    assert all(equation.CONSERVATIVE for equation in equations_batch)
+    results = integrate_baseline(equations_batch, accuracy_order)
+    accuracy_index = accuracy_orders.index(accuracy_order)
+    for seed, (y, num_evals) in zip(seeds, results):
+      # seeds are also the indices of samples
+      write_result(path, seed, accuracy_index, y, num_evals)
+      yield seed, accuracy_order
+
+  seeds = list(range(FLAGS.num_samples))
+  seed_batches = [seeds[i:i + FLAGS.batch_size]
+                  for i in range(0, len(seeds), FLAGS.batch_size)]
 
   pipeline = (
-      beam.Create(list(range(FLAGS.num_samples)))
+      beam.Create(seed_batches)
+      # equations only depend on the seed, so build each one only once
+      | beam.Map(lambda seeds: (seeds, [create_equation(s) for s in seeds]))
       | beam.FlatMap(
-          lambda seed: [(seed, accuracy) for accuracy in accuracy_orders])
-      | beam.Map(create_equation_and_integrate)
-      | beam.CombinePerKey(xarray_beam.ConcatCombineFn('accuracy_order'))
-      | beam.Map(lambda seed_and_ds: seed_and_ds[1].sortby('accuracy_order'))
-      | beam.CombineGlobally(xarray_beam.ConcatCombineFn('sample'))
-      | beam.Map(lambda ds: ds.sortby('sample'))
-      | beam.Map(xarray_beam.write_netcdf, path=FLAGS.output_path))
-
-  runner.run(pipeline)
+          lambda seeds_and_equations: [seeds_and_equations + (accuracy,)
+                                       for accuracy in accuracy_orders])
+      | beam.BatchElements(min_batch_size=1, max_batch_size=FLAGS.num_threads)
+      | beam.ParDo(ThreadPoolFlatMap(integrate_and_write, FLAGS.num_threads)))
+
+  try:
+    create_output_file(local_path, seeds, sorted_accuracy_orders,
+                       FLAGS.warmup + times, create_equation(0).grid.solution_x)
+    # only copy results after every worker has finished writing them
+    runner.run(pipeline, options).wait_until_finish()
+    tf.gfile.Copy(local_path, FLAGS.output_path, overwrite=True)
+  finally:
+    shutil.rmtree(tmp_dir)
 
 
 if __name__ == '__main__':
@@ -52,6 +52,10 @@ class CreateBaselineDataTest(absltest.TestCase):
       self.assertEqual(ds['y'].dims, ('sample', 'accuracy_order', 'time', 'x'))
       self.assertEqual(ds['y'].shape, (2, 3, 11, 400))
 
+  def test_requires_direct_runner(self):
+    with self.assertRaisesRegex(ValueError, 'DirectRunner'):
+      create_baseline_data.main([], runner=object())
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -20,6 +20,8 @@ INSTALL_REQUIRES = [
     'absl-py',
     'apache-beam',
     'h5py',
+    'netCDF4',
+    'numba',
     'numpy',
     'pandas',
     'scipy',